@@ -1,87 +1,557 @@
-import json
-from typing import List, Tuple
-from openai import OpenAI
-from pydantic import BaseModel, Field
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import diskcache
+from aiolimiter import AsyncLimiter
+import msgspec
+import tiktoken
+from openai import APIConnectionError, AsyncOpenAI, AuthenticationError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from models import (
+    BATCH_DECODER,
+    BatchOutput,
+    ChapterOutput,
+    ChapterOutputStruct,
+    Scene,
+    parse_scenes,
+    to_scene,
+    unique_by_trigger,
+)
 
 # --- CONFIGURATION ---
-SKYBOX_NEGATIVE_PROMPT = (
-    "people, person, faces, crowds, animals, text, letters, signage, "
-    "watermark, logo, UI, placeable props, furniture, vehicles, "
-    "modern objects, anachronistic items, blurry"
-)
+# Cheapest model first; a response is escalated to the next one if it fails validation
+# or finds fewer than MIN_SCENES scenes.
+MODELS = ["gpt-4o-mini", "gpt-4o"]
+MIN_SCENES = 2
+CACHE_DIR = ".llm_cache"
+CACHE_TTL_SECONDS = 7 * 86400
+# Part of every cache key. Bump it when a change alters results without changing the prompt
+# text (response schema, post-processing), so stale entries stop matching.
+PROMPT_VERSION = 1
+
+# Chunks are trimmed by tokens so each call uses the context window without overflowing it.
+MAX_CONTEXT_TOKENS = 128000
+RESPONSE_RESERVE_TOKENS = 16384
+# Message framing, the user-message preamble and the response_format schema.
+REQUEST_OVERHEAD_TOKENS = 1024
+# Batches are packed by token count; the output cap (16k for GPT-4o) bounds how many chunks fit.
+BATCH_MAX_INPUT_TOKENS = 60000
+BATCH_MAX_CHUNKS = 6
+# Chunks in flight at once in analyze_chapters_concurrently.
+MAX_CONCURRENCY = 10
+# Calls wait for the whole response: up to a few thousand output tokens per chapter, more per batch.
+REQUEST_TIMEOUT_SECONDS = 120.0
+BATCH_REQUEST_TIMEOUT_SECONDS = 300.0
+# Retries per request, all done by _retry_transient; the SDK's own retries are switched off.
+MAX_RETRIES = 5
+# Default pacing for the concurrent runner (OpenAI tier-1 limits for gpt-4o-mini).
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+
+# Near-duplicate lookup needs the optional faiss-cpu + sentence-transformers packages.
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_THRESHOLD = 0.97
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# --- CACHE ---
+CACHE = diskcache.Cache(CACHE_DIR)
+
+@lru_cache(maxsize=32)
+def _prompt_digest(system_instructions: str) -> str:
+    # System prompts are themselves cached, so each one is hashed once per process.
+    payload = f"v{PROMPT_VERSION}|{system_instructions}".encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def _cache_key(model_name: str, system_instructions: str, text_chunk: str) -> str:
+    payload = f"{model_name}|{_prompt_digest(system_instructions)}|{text_chunk}".encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+class SemanticCache:
+    """
+    Embedding index over previously analyzed chunks, so light re-edits of a chapter still hit.
+    Vectors live in a FAISS index next to CACHE; the responses themselves are stored in CACHE.
+    """
+    def __init__(self, index_path: str, threshold: float):
+        self.index_path = index_path
+        self.threshold = threshold
+        self._encoder = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        import faiss
+        from sentence_transformers import SentenceTransformer
+
+        self._encoder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        if os.path.exists(self.index_path):
+            self._index = faiss.read_index(self.index_path)
+        else:
+            self._index = faiss.IndexFlatIP(self._encoder.get_sentence_embedding_dimension())
+
+    def embed(self, text: str):
+        with self._lock:
+            if self._index is None:
+                self._load()
+        return self._encoder.encode([text], normalize_embeddings=True)
 
-# --- DATA MODELS ---
-class Character(BaseModel):
-    name: str = Field(..., description="Name of the character")
-    role: str = Field(..., description="Role: 'Main' or 'Secondary'")
-    visual_description: str = Field(..., description="Visual description only. Full-body character cutout, no text cues.")
+    def lookup(self, vector, prompt_key: str) -> Optional[str]:
+        if self._index.ntotal == 0:
+            return None
+        scores, ids = self._index.search(vector, min(4, self._index.ntotal))
+        for score, idx in zip(scores[0], ids[0]):
+            if score < self.threshold:
+                break
+            entry = CACHE.get(f"semantic:{idx}")
+            # Same text under a different book title (i.e. system prompt) is not a hit. Which model
+            # answered doesn't matter: like the exact cache, any model's stored answer is reused.
+            if entry is not None and entry[0] == prompt_key:
+                return entry[1]
+        return None
 
-class Skybox(BaseModel):
-    visual_prompt: str = Field(..., description="Environment description. POV: ground view, center eye level.")
-    environment_type: str = Field(..., description="'Indoors' or 'Outdoors'")
+    def add(self, vector, prompt_key: str, raw_json: str):
+        import faiss
 
-class Scene(BaseModel):
-    location: str
-    chapter_beat: str
-    trigger_sentence: str = Field(..., description="Verbatim sentence from text.")
-    characters: List[Character]
-    skybox_environment: Skybox
+        with self._lock:
+            CACHE.set(f"semantic:{self._index.ntotal}", (prompt_key, raw_json), expire=CACHE_TTL_SECONDS)
+            self._index.add(vector)
+            faiss.write_index(self._index, self.index_path)
 
-class ChapterOutput(BaseModel):
-    scenes: List[Scene]
+SEMANTIC_CACHE = SemanticCache(os.path.join(CACHE_DIR, "semantic.faiss"), SEMANTIC_CACHE_THRESHOLD)
+
+# --- CLIENTS ---
+def _new_async_client(api_key: str) -> AsyncOpenAI:
+    # Async clients are bound to the event loop they were used on, so one is made per run
+    # (not per chunk) and shared by every coroutine in it. Its built-in retries would bypass the
+    # limiter and multiply with _retry_transient, so they are off.
+    return AsyncOpenAI(api_key=api_key, timeout=REQUEST_TIMEOUT_SECONDS, max_retries=0)
+
+# --- RATE LIMITING ---
+class RateLimiter:
+    """
+    Token-bucket pacing for one concurrent run: a requests-per-minute and a tokens-per-minute budget.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self._requests = AsyncLimiter(requests_per_minute, 60)
+        self._tokens = AsyncLimiter(tokens_per_minute, 60)
+
+    async def acquire(self, n_tokens: int):
+        await self._requests.acquire()
+        # A single request larger than the whole bucket just waits for a full bucket.
+        await self._tokens.acquire(min(n_tokens, self._tokens.max_rate))
+
+def _is_transient(e: BaseException) -> bool:
+    # The failures the SDK would have retried: 429s, 5xx and dropped or timed-out connections.
+    # An exhausted quota also surfaces as a 429, but waiting won't fix it.
+    if isinstance(e, RateLimitError):
+        return getattr(e, "code", None) != "insufficient_quota"
+    return isinstance(e, (APIConnectionError, InternalServerError))
+
+# The only retry policy: back off for up to a few minutes before giving up on a chunk,
+# re-acquiring the limiter on every attempt.
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_exponential_jitter(1, 30),
+    stop=stop_after_attempt(MAX_RETRIES + 1),
+    reraise=True,
+)
+
+@_retry_transient
+async def _create_completion_async(client: AsyncOpenAI, limiter: Optional[RateLimiter], n_tokens: int, **kwargs):
+    if limiter is not None:
+        await limiter.acquire(n_tokens)
+    return await client.chat.completions.create(**kwargs)
 
 # --- PROMPT ---
+# Kept terse on purpose: every token here is billed once per chunk. The output shape
+# is enforced by the response_format schemas below, not described in the prompt.
+@lru_cache(maxsize=32)
 def generate_system_prompt(book_title: str) -> str:
-    return f"""
-    You are the Cinematic Director for the AR project: "{book_title}".
-    
-    GOAL: Extract cinematic moments for Augmented Reality.
-    
-    RULES:
-    1. FIND AT LEAST 3 SCENES in this text chunk.
-    2. Triggers must be VERBATIM text.
-    3. Skybox prompts must be ENVIRONMENT ONLY (no people).
-    4. Character descriptions must be VISUALS ONLY (no text cues).
-    
-    OUTPUT: Return valid JSON matching the schema.
+    return (
+        f'ROLE: Cinematic Director, AR project "{book_title}".\n'
+        "GOAL: extract cinematic moments for AR.\n"
+        "RULES: 1)scenes>=3 2)trigger_sentence=verbatim from text 3)skybox=environment only, no people "
+        "4)characters=visuals only, no text cues 5)no two scenes share a trigger_sentence"
+    )
+
+@lru_cache(maxsize=32)
+def generate_batch_system_prompt(book_title: str) -> str:
+    return generate_system_prompt(book_title) + (
+        "\nBATCH: input chunks start with ===CHUNK id=<id>===; apply RULES to each chunk, "
+        "one chunks entry per chunk with chapter_id=<id>"
+    )
+
+def _response_format(model: type) -> dict:
+    """
+    Builds an OpenAI structured-output response_format from a pydantic model.
+    Strict mode needs every object closed and every property listed as required.
     """
+    schema = model.model_json_schema()
+    for definition in [schema, *schema.get("$defs", {}).values()]:
+        if definition.get("type") == "object":
+            definition["additionalProperties"] = False
+            definition["required"] = list(definition["properties"])
+    return {"type": "json_schema", "json_schema": {"name": model.__name__, "schema": schema, "strict": True}}
+
+CHAPTER_RESPONSE_FORMAT = _response_format(ChapterOutput)
+BATCH_RESPONSE_FORMAT = _response_format(BatchOutput)
+
+# --- PREPROCESSING ---
+# Citation markers ([cite_start], [cite: 5]) and zero-width/BOM characters carry no meaning
+# for the model but still cost tokens.
+_NOISE = re.compile(r"\[cite[^\]]*\]|[\u200b\ufeff]")
+_SPACES = re.compile(r"[ \t]+")
+_BLANK_LINES = re.compile(r"[ \t]*\n\s*\n[ \t]*")
+
+def _clean_chunk(text_chunk: str) -> str:
+    text_chunk = _SPACES.sub(" ", _NOISE.sub("", text_chunk))
+    return _BLANK_LINES.sub("\n\n", text_chunk).strip()
+
+# --- BATCHING ---
+@lru_cache(maxsize=None)
+def _get_encoding() -> tiktoken.Encoding:
+    # Every model in MODELS shares the same tokenizer.
+    return tiktoken.encoding_for_model(MODELS[-1])
+
+@lru_cache(maxsize=32)
+def _prompt_tokens(system_instructions: str) -> int:
+    return len(_get_encoding().encode_ordinary(system_instructions))
+
+def _truncate_chunk(text_chunk: str, system_instructions: str) -> Tuple[str, int]:
+    """
+    Trims text_chunk to the tokens left after the system prompt, overhead and response reserve.
+    Returns the text and its token count.
+    """
+    budget = MAX_CONTEXT_TOKENS - RESPONSE_RESERVE_TOKENS - REQUEST_OVERHEAD_TOKENS - _prompt_tokens(system_instructions)
+    encoding = _get_encoding()
+    tokens = encoding.encode_ordinary(text_chunk)
+    if len(tokens) <= budget:
+        return text_chunk, len(tokens)
+    return encoding.decode(tokens[:budget]), budget
+
+def _pack_chunks(chunks: List[Tuple[str, str, int]], max_tokens: int, max_chunks: int) -> Iterator[Tuple[List[Tuple[str, str, int]], int]]:
+    """
+    Greedily groups (chapter_id, text, n_tokens) chunks so each group stays under max_tokens of input.
+    Yields (group, token count) pairs.
+    """
+    batch, batch_tokens = [], 0
+    for chunk in chunks:
+        n_tokens = chunk[2]
+        if batch and (batch_tokens + n_tokens > max_tokens or len(batch) >= max_chunks):
+            yield batch, batch_tokens
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += n_tokens
+    if batch:
+        yield batch, batch_tokens
 
 # --- ANALYZER ---
-def analyze_chapter_content(api_key: str, text_chunk: str, book_title: str) -> Tuple[List[Scene], str]:
+# Outcome counts per (model, "accepted" | "escalated"), for tuning the MODELS order.
+MODEL_STATS = Counter()
+
+def _check_cache(system_instructions: str, text_chunk: str):
+    """
+    Returns (scenes, vector): scenes on a cache hit, else None; vector is the
+    semantic-cache embedding to store alongside the fresh result (None when disabled).
+    """
+    for model_name in MODELS:
+        cached_json = CACHE.get(_cache_key(model_name, system_instructions, text_chunk))
+        if cached_json is not None:
+            return parse_scenes(cached_json), None
+
+    vector = None
+    if SEMANTIC_CACHE_ENABLED:
+        vector = SEMANTIC_CACHE.embed(text_chunk)
+        cached_json = SEMANTIC_CACHE.lookup(vector, _prompt_digest(system_instructions))
+        if cached_json is not None:
+            return parse_scenes(cached_json), vector
+    return None, vector
+
+def _store_cache(model_name: str, system_instructions: str, text_chunk: str, vector, raw_json: Union[str, bytes]):
+    CACHE.set(_cache_key(model_name, system_instructions, text_chunk), raw_json, expire=CACHE_TTL_SECONDS)
+    if vector is not None:
+        SEMANTIC_CACHE.add(vector, _prompt_digest(system_instructions), raw_json)
+
+def _accept_response(model_name: str, raw_json: str) -> Tuple[List[Scene], str]:
     """
-    Analyzes content using OpenAI GPT-4o.
+    Validates one model's response.
+    Returns (scenes, None) when it is good enough to keep, or (scenes, reason) when it fell short.
+    """
+    try:
+        scenes = parse_scenes(raw_json)
+    except Exception as json_err:
+        MODEL_STATS[model_name, "escalated"] += 1
+        return [], f"JSON Parsing Failed: {json_err}"
+
+    if len(scenes) < MIN_SCENES:
+        # The last model has nowhere to escalate to; its answer counts as accepted either way.
+        MODEL_STATS[model_name, "accepted" if model_name == MODELS[-1] else "escalated"] += 1
+        return scenes, f"Only {len(scenes)} scenes found"
+
+    MODEL_STATS[model_name, "accepted"] += 1
+    return scenes, None
+
+def _build_messages(system_instructions: str, text_chunk: str) -> List[dict]:
+    return [
+        {"role": "system", "content": system_instructions},
+        {"role": "user", "content": f"Analyze this text chunk:\n\n{text_chunk}"}
+    ]
+
+async def analyze_chapter_content_async(client: AsyncOpenAI, text_chunk: str, book_title: str, limiter: Optional[RateLimiter] = None) -> Tuple[List[Scene], str]:
+    """
+    Analyzes content using OpenAI, starting with the cheapest model in MODELS.
+    Validated responses are cached on disk, so re-runs of the same chapter skip the API call.
+    Takes a shared AsyncOpenAI client so many chunks can be in flight; each request
+    (including escalations) waits on limiter, if given, before it is sent.
     """
     try:
-        client = OpenAI(api_key=api_key)
-        
         system_instructions = generate_system_prompt(book_title)
-        
-        # We limit the chunk to ~40k chars to stay safe, though GPT-4o has 128k context.
-        response = client.chat.completions.create(
-            model="gpt-4o", 
-            messages=[
-                {"role": "system", "content": system_instructions},
-                {"role": "user", "content": f"Analyze this text chunk:\n\n{text_chunk[:45000]}"}
-            ],
-            response_format={"type": "json_object"}
-        )
-        
-        raw_json = response.choices[0].message.content
-        
-        try:
-            data = json.loads(raw_json)
-            # OpenAI sometimes wraps the list in a root key like "scenes", 
-            # Pydantic handles validation, but we ensure the root matches ChapterOutput
-            structured_data = ChapterOutput(**data)
-        except Exception as json_err:
-            return [], f"JSON Parsing Failed: {json_err}"
-
-        # Add Negative Prompts
-        for scene in structured_data.scenes:
-            if not hasattr(scene.skybox_environment, 'negative_prompt'):
-                scene.skybox_environment.negative_prompt = SKYBOX_NEGATIVE_PROMPT
-            
-        return structured_data.scenes, None
+
+        text_chunk, n_tokens = _truncate_chunk(_clean_chunk(text_chunk), system_instructions)
+        scenes, vector = _check_cache(system_instructions, text_chunk)
+        if scenes is not None:
+            return scenes, None
+
+        n_tokens += _prompt_tokens(system_instructions)
+        messages = _build_messages(system_instructions, text_chunk)
+
+        scenes, best_model, best_json, error = [], None, None, None
+        for model_name in MODELS:
+            response = await _create_completion_async(
+                client,
+                limiter,
+                n_tokens,
+                model=model_name,
+                messages=messages,
+                response_format=CHAPTER_RESPONSE_FORMAT
+            )
+            raw_json = response.choices[0].message.content
+            attempt, error = _accept_response(model_name, raw_json)
+            # A pricier model can still do worse, so the best answer so far is kept, not the last.
+            if len(attempt) > len(scenes):
+                scenes, best_model, best_json = attempt, model_name, raw_json
+            if error is None:
+                break
+
+        if not scenes:
+            # Empty answers are never cached, so the next run asks again.
+            return [], error
+        # A thin result still beats none, and is cached so chapters that really have one scene aren't re-sent.
+        _store_cache(best_model, system_instructions, text_chunk, vector, best_json)
+        return scenes, None
 
     except Exception as e:
         return [], str(e)
+
+def analyze_chapter_content(api_key: str, text_chunk: str, book_title: str) -> Tuple[List[Scene], str]:
+    """
+    Blocking wrapper around analyze_chapter_content_async for a single chapter.
+    Must not be called from inside a running event loop.
+    """
+    async def run():
+        async with _new_async_client(api_key) as client:
+            return await analyze_chapter_content_async(client, text_chunk, book_title)
+
+    return asyncio.run(run())
+
+def _collect(results: List[Tuple[List[Scene], str]]) -> Tuple[List[Scene], List[Tuple[int, str]]]:
+    """
+    Flattens per-chunk (scenes, error) pairs into (scenes, errors), keeping input order.
+    errors lists (chunk index, error) for each chunk that failed.
+    """
+    scenes = [scene for chunk_scenes, _ in results for scene in chunk_scenes]
+    errors = [(i, error) for i, (_, error) in enumerate(results) if error]
+    return scenes, errors
+
+async def analyze_chapters_concurrently(api_key: str, chunks: List[str], book_title: str, max_concurrency: int = MAX_CONCURRENCY, on_progress: Optional[Callable[[int, int], None]] = None, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE) -> Tuple[List[Scene], List[Tuple[int, str]]]:
+    """
+    Analyzes all chunks concurrently, at most max_concurrency at a time and paced to the given
+    per-minute request/token budgets, so large books stay under the provider's rate limits.
+    Returns (scenes, errors): every scene found, in input order, and (chunk index, error) for each
+    chunk that failed. on_progress(done, total) is called as each chunk finishes, in completion order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    done = 0
+
+    async with _new_async_client(api_key) as client:
+        async def run(text_chunk: str):
+            nonlocal done
+            async with semaphore:
+                result = await analyze_chapter_content_async(client, text_chunk, book_title, limiter=limiter)
+            done += 1
+            if on_progress is not None:
+                on_progress(done, len(chunks))
+            return result
+
+        results = await asyncio.gather(*(run(text_chunk) for text_chunk in chunks))
+    return _collect(results)
+
+def _prepare_chunks(chunks: List[Tuple[str, str]], system_instructions: str, results: Dict[str, List[Scene]]) -> List[Tuple[str, str, int]]:
+    """
+    Cleans and trims (chapter_id, text_chunk) pairs and fills results from the cache.
+    Returns (chapter_id, text_chunk, n_tokens) for the chunks that still have to be sent;
+    the token counts come from trimming, so no chunk is encoded twice.
+    """
+    pending = []
+    for chapter_id, text_chunk in chunks:
+        text_chunk, n_tokens = _truncate_chunk(_clean_chunk(text_chunk), system_instructions)
+        # Same keys as analyze_chapter_content_async, so single and batched runs share cache entries.
+        scenes, _ = _check_cache(system_instructions, text_chunk)
+        if scenes is not None:
+            results[chapter_id] = scenes
+        else:
+            pending.append((chapter_id, text_chunk, n_tokens))
+    return pending
+
+def _batch_messages(batch_instructions: str, batch: List[Tuple[str, str, int]]) -> List[dict]:
+    user_content = "Analyze each text chunk:" + "".join(
+        f"\n\n===CHUNK id={chapter_id}===\n{text_chunk}" for chapter_id, text_chunk, _ in batch
+    )
+    return [
+        {"role": "system", "content": batch_instructions},
+        {"role": "user", "content": user_content}
+    ]
+
+def _accept_batch_response(model_name: str, raw_json: str, batch: List[Tuple[str, str, int]], system_instructions: str, results: Dict[str, List[Scene]], thin: Dict[str, tuple]) -> List[Tuple[str, str, int]]:
+    """
+    Validates one model's answer for a batch, caching and storing the chunks it covered well enough.
+    Under-covered chunks are stored only if they beat what an earlier model gave, and noted in thin.
+    Returns the chunks to re-send to the next model.
+    """
+    try:
+        batch_output = BATCH_DECODER.decode(raw_json)
+    except Exception:
+        MODEL_STATS[model_name, "escalated"] += 1
+        return batch
+
+    is_last = model_name == MODELS[-1]
+    # Ids the model invented are ignored.
+    returned = {chunk.chapter_id: unique_by_trigger(chunk.scenes) for chunk in batch_output.chunks}
+    escalate = []
+    for chunk in batch:
+        chapter_id, text_chunk, _ = chunk
+        scene_structs = returned.get(chapter_id)
+        if scene_structs is not None and len(scene_structs) >= MIN_SCENES:
+            chapter_json = msgspec.json.encode(ChapterOutputStruct(scenes=scene_structs))
+            _store_cache(model_name, system_instructions, text_chunk, None, chapter_json)
+            results[chapter_id] = [to_scene(s) for s in scene_structs]
+            thin.pop(chapter_id, None)
+            continue
+        if scene_structs and len(scene_structs) > len(results.get(chapter_id, ())):
+            results[chapter_id] = [to_scene(s) for s in scene_structs]
+            thin[chapter_id] = (model_name, text_chunk, scene_structs)
+        if is_last and scene_structs is not None:
+            # Answered, just thinly: report what there is instead of re-sending the chapter on its own.
+            results.setdefault(chapter_id, [])
+        else:
+            escalate.append(chunk)
+
+    MODEL_STATS[model_name, "accepted"] += len(batch) - len(escalate)
+    MODEL_STATS[model_name, "escalated"] += len(escalate)
+    return escalate
+
+async def _analyze_batch_async(client: AsyncOpenAI, limiter: RateLimiter, batch: List[Tuple[str, str, int]], batch_tokens: int, batch_instructions: str, system_instructions: str, results: Dict[str, List[Scene]]):
+    """
+    Sends one batch of batch_tokens chunk tokens, re-sending the chunks a cheaper model missed or
+    under-covered to the next model. Every attempt, escalations included, waits on limiter for its
+    own tokens. Scenes are written into results; chunks still absent from it afterwards got nothing usable.
+    """
+    prompt_tokens = _prompt_tokens(batch_instructions)
+    thin: Dict[str, tuple] = {}
+    for model_name in MODELS:
+        response = await _create_completion_async(
+            client,
+            limiter,
+            prompt_tokens + batch_tokens,
+            model=model_name,
+            messages=_batch_messages(batch_instructions, batch),
+            response_format=BATCH_RESPONSE_FORMAT,
+            timeout=BATCH_REQUEST_TIMEOUT_SECONDS
+        )
+        batch = _accept_batch_response(model_name, response.choices[0].message.content, batch, system_instructions, results, thin)
+        if not batch:
+            break
+        batch_tokens = sum(n_tokens for _, _, n_tokens in batch)
+
+    # Every model has had its turn, so the best thin answers are final; empty ones are never cached.
+    for model_name, text_chunk, scene_structs in thin.values():
+        chapter_json = msgspec.json.encode(ChapterOutputStruct(scenes=scene_structs))
+        _store_cache(model_name, system_instructions, text_chunk, None, chapter_json)
+
+async def analyze_chapters_in_batches(api_key: str, chunks: List[str], book_title: str, batch_size: int = BATCH_MAX_CHUNKS, max_concurrency: int = MAX_CONCURRENCY, on_progress: Optional[Callable[[int, int], None]] = None, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE) -> Tuple[List[Scene], List[Tuple[int, str]]]:
+    """
+    Like analyze_chapters_concurrently, but packs up to batch_size uncached chunks into each request,
+    paying the system prompt and round trip once per batch, with the batches themselves running concurrently.
+    Every request is paced: each batch attempt, each escalation to the next model, and the
+    single-chapter re-sends for chapters a failed batch left out.
+    Returns (scenes, errors) in the same shape as analyze_chapters_concurrently.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    # One slot per chunk, written as batches finish, so scene order never depends on completion order.
+    results: List[Tuple[List[Scene], str]] = [([], None)] * len(chunks)
+    scenes_by_id: Dict[str, List[Scene]] = {}
+
+    try:
+        system_instructions = generate_system_prompt(book_title)
+        batch_instructions = generate_batch_system_prompt(book_title)
+        # Cached chunks are settled here, before anything waits on the limiter.
+        indexed = [(str(i), text_chunk) for i, text_chunk in enumerate(chunks)]
+        pending = await asyncio.to_thread(_prepare_chunks, indexed, system_instructions, scenes_by_id)
+    except Exception as e:
+        return [], [(i, str(e)) for i in range(len(chunks))]
+
+    done = len(chunks) - len(pending)
+    if done and on_progress is not None:
+        on_progress(done, len(chunks))
+
+    async with _new_async_client(api_key) as client:
+        async def run(batch: List[Tuple[str, str, int]], batch_tokens: int):
+            nonlocal done
+            async with semaphore:
+                try:
+                    await _analyze_batch_async(client, limiter, batch, batch_tokens, batch_instructions, system_instructions, scenes_by_id)
+                    batch_error = None
+                except AuthenticationError as e:
+                    # Re-sending with a rejected key would fail the same way.
+                    batch_error = str(e)
+                except Exception:
+                    # Whatever the batch returned before failing is kept; the rest is re-sent below.
+                    batch_error = None
+                for chapter_id, _, _ in batch:
+                    if chapter_id in scenes_by_id:
+                        continue
+                    i = int(chapter_id)
+                    if batch_error:
+                        results[i] = ([], batch_error)
+                    else:
+                        results[i] = await analyze_chapter_content_async(client, chunks[i], book_title, limiter=limiter)
+            done += len(batch)
+            if on_progress is not None:
+                on_progress(done, len(chunks))
+
+        await asyncio.gather(*(run(batch, batch_tokens) for batch, batch_tokens in _pack_chunks(pending, BATCH_MAX_INPUT_TOKENS, batch_size)))
+
+    for chapter_id, scenes in scenes_by_id.items():
+        results[int(chapter_id)] = (scenes, None)
+    return _collect(results)
+
+# --- WARMUP ---
+def _warmup():
+    # Loads the tokenizer (and the embedding model, if enabled) while the user is still
+    # uploading a book, instead of on the first Generate click. Pydantic builds the model
+    # validators when the classes are defined, so importing models.py already covers them.
+    try:
+        _get_encoding()
+        if SEMANTIC_CACHE_ENABLED:
+            SEMANTIC_CACHE.embed("warmup")
+    except Exception:
+        # Offline or missing optional deps: the same loads simply happen on first use.
+        pass
+
+threading.Thread(target=_warmup, daemon=True).start()
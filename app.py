@@ -3,71 +3,234 @@ import streamlit as st
 # --- 1. CONFIGURATION (MUST BE FIRST) ---
 st.set_page_config(page_title="OutPaged Scene Generator", layout="wide")
 
+import asyncio
 import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import warnings
+import zipfile
+from xml.sax.saxutils import escape
 warnings.filterwarnings("ignore")
 
 from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 import analyzer 
+import models
 
 # --- 2. EPUB LOGIC ---
-def parse_epub(uploaded_file):
+# Subtrees dropped before text extraction: metadata, code and navigation chrome.
+SKIP_TAGS = ('head', 'script', 'style', 'nav')
+MIN_CHAPTER_CHARS = 500
+# A document's text can't be longer than its bytes, so documents smaller than this are skipped
+# before parsing. Kept at the bound: markup overhead varies too much to subtract safely.
+MIN_CHAPTER_BYTES = MIN_CHAPTER_CHARS
+
+def get_title(book):
+    title_meta = book.get_metadata('DC', 'title')
+    return title_meta[0][0] if title_meta else "Untitled Book"
+
+def iter_chapters(book):
+    """
+    Yields each chapter's text in reading order; only one document's tree is alive at a time.
+    """
+    # The spine, not the manifest, gives reading order; it lists (idref, linear) pairs.
+    items = {item.id: item for item in book.get_items()}
+    for item_id, _ in book.spine:
+        item = items.get(item_id)
+        if item is None or item.get_type() != ebooklib.ITEM_DOCUMENT:
+            continue
+        raw = item.get_content()
+        if len(raw) < MIN_CHAPTER_BYTES:
+            continue
+        # lxml walks the text nodes in C; there is no Python-level tree as with BeautifulSoup.
+        root = lxml.html.fromstring(raw)
+        etree.strip_elements(root, *SKIP_TAGS, with_tail=False)
+        text = "\n".join(t.strip() for t in root.itertext() if t and not t.isspace())
+        if len(text) > MIN_CHAPTER_CHARS:
+            yield text
+
+# Keyed on the file's bytes, so widget interactions and reruns don't re-parse the same book.
+# The chapter list is materialized here because the analyzer sends chapters concurrently.
+@st.cache_data(show_spinner=False)
+def parse_epub(epub_bytes):
     try:
-        book = epub.read_epub(uploaded_file)
-        title_meta = book.get_metadata('DC', 'title')
-        book_title = title_meta[0][0] if title_meta else "Untitled Book"
-        
-        chapters = []
-        for item in book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text = soup.get_text(separator='\n').strip()
-                if len(text) > 500:
-                    chapters.append(text)
-        return book_title, chapters
+        book = epub.read_epub(io.BytesIO(epub_bytes))
+        return get_title(book), list(iter_chapters(book))
     except Exception as e:
         return "Error", []
 
 # --- 3. DOC GENERATOR ---
-def generate_documents(book_title, all_scenes):
-    doc1 = Document(); doc1.add_heading(f"{book_title} | Triggers", 0)
-    doc2 = Document(); doc2.add_heading(f"{book_title} | Skybox", 0)
-    doc3 = Document(); doc3.add_heading(f"{book_title} | Characters", 0)
-    
-    idx = 1
-    for scene in all_scenes:
-        s_id = f"ch{idx:02}"
-        
-        # Doc 1
-        doc1.add_heading(f"Scene {idx:02}: {scene.location}", level=2)
-        doc1.add_paragraph(f"Trigger: {scene.trigger_sentence}")
-        doc1.add_paragraph(f"Page: N/A")
-        
-        # Doc 2
-        neg = getattr(scene.skybox_environment, 'negative_prompt', analyzer.SKYBOX_NEGATIVE_PROMPT)
-        doc2.add_heading(f"Scene {idx:02}: {scene.location}", level=2)
-        doc2.add_paragraph(f"File: {s_id}bg01")
-        doc2.add_paragraph(f"Prompt: {scene.skybox_environment.visual_prompt}")
-        doc2.add_paragraph(f"Negative: {neg}")
-        
-        # Doc 3
-        doc3.add_heading(f"Scene {idx:02}: {scene.location}", level=2)
+TITLE_STYLE = "Title"
+HEADING_STYLE = "Heading2"  # style id of "Heading 2" in the default template
+# Writes word/document.xml straight into the zip, paragraph by paragraph, instead of building a
+# python-docx tree and serializing it on save. Uses the minimal package below, not python-docx's template.
+# Default for the sidebar toggle; set LOW_MEMORY=1 in the environment to start with it on.
+LOW_MEMORY = os.environ.get("LOW_MEMORY", "").lower() in ("1", "true", "yes")
+# Characters XML 1.0 can't hold (control codes, lone surrogates), even escaped. Both writers drop
+# them: lxml would raise on them and the streamed XML would be unreadable.
+XML_ILLEGAL = re.compile(r'[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+def fast_para(text, style=None):
+    """
+    Builds a <w:p><w:r><w:t> element directly, skipping python-docx's Paragraph/Run wrappers.
+    """
+    p = OxmlElement('w:p')
+    if style:
+        p_pr = OxmlElement('w:pPr')
+        p_style = OxmlElement('w:pStyle')
+        p_style.set(qn('w:val'), style)
+        p_pr.append(p_style)
+        p.append(p_pr)
+    r = OxmlElement('w:r')
+    t = OxmlElement('w:t')
+    t.set(qn('xml:space'), 'preserve')
+    t.text = XML_ILLEGAL.sub('', text)
+    r.append(t)
+    p.append(r)
+    return p
+
+def append_paras(doc, paras):
+    body = doc.element.body
+    # One splice, kept ahead of the trailing <w:sectPr> like python-docx does.
+    idx = len(body) - 1 if body.sectPr is not None else len(body)
+    body[idx:idx] = paras
+
+def to_stream(doc):
+    s = io.BytesIO(); doc.save(s); s.seek(0); return s
+
+def build_docx(rows):
+    doc = Document()
+    append_paras(doc, [fast_para(text, style) for text, style in rows])
+    return to_stream(doc)
+
+# Minimal WordprocessingML package for LOW_MEMORY: just the parts Word needs, plus the two styles we use.
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+DOCX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{REL_NS}">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        '</Relationships>'
+    ),
+    "word/_rels/document.xml.rels": (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{REL_NS}">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    "word/styles.xml": (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:styles xmlns:w="{W_NS}">'
+        '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/></w:style>'
+        f'<w:style w:type="paragraph" w:styleId="{TITLE_STYLE}"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:spacing w:after="240"/></w:pPr><w:rPr><w:sz w:val="56"/></w:rPr></w:style>'
+        f'<w:style w:type="paragraph" w:styleId="{HEADING_STYLE}"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:keepNext/><w:spacing w:before="200"/><w:outlineLvl w:val="1"/></w:pPr><w:rPr><w:b/><w:sz w:val="26"/></w:rPr></w:style>'
+        '</w:styles>'
+    ),
+}
+DOCUMENT_HEAD = f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document xmlns:w="{W_NS}"><w:body>'.encode()
+DOCUMENT_TAIL = (
+    '<w:sectPr><w:pgSz w:w="12240" w:h="15840"/><w:pgMar w:top="1440" w:right="1440" w:bottom="1440" '
+    'w:left="1440" w:header="720" w:footer="720" w:gutter="0"/></w:sectPr></w:body></w:document>'
+).encode()
+
+def para_xml(text, style=None):
+    p_pr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+    text = escape(XML_ILLEGAL.sub('', text))
+    return f'<w:p>{p_pr}<w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+def stream_docx(rows):
+    """
+    Writes a .docx without a document tree: only one paragraph's XML is held at a time.
+    """
+    s = io.BytesIO()
+    with zipfile.ZipFile(s, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in DOCX_PARTS.items():
+            zf.writestr(name, xml)
+        with zf.open("word/document.xml", 'w') as part:
+            part.write(DOCUMENT_HEAD)
+            for text, style in rows:
+                part.write(para_xml(text, style).encode())
+            part.write(DOCUMENT_TAIL)
+    s.seek(0)
+    return s
+
+# Each document is a generator of (text, style) rows, so either writer can consume it.
+# `nums` is a shared, read-only table of zero-padded numbers ("00", "01", ...) built once in
+# generate_documents, so the per-scene/per-character loops only concatenate strings.
+def trigger_rows(book_title, all_scenes, nums):
+    yield f"{book_title} | Triggers", TITLE_STYLE
+    for idx, scene in enumerate(all_scenes, 1):
+        yield "Scene " + nums[idx] + ": " + scene.location, HEADING_STYLE
+        yield "Trigger: " + scene.trigger_sentence, None
+        yield "Page: N/A", None
+
+def skybox_rows(book_title, all_scenes, nums):
+    yield f"{book_title} | Skybox", TITLE_STYLE
+    for idx, scene in enumerate(all_scenes, 1):
+        sky = scene.skybox_environment
+        yield "Scene " + nums[idx] + ": " + scene.location, HEADING_STYLE
+        yield "File: ch" + nums[idx] + "bg01", None
+        yield "Prompt: " + sky.visual_prompt, None
+        # Always set: Skybox.negative_prompt defaults to models.SKYBOX_NEGATIVE_PROMPT.
+        yield "Negative: " + sky.negative_prompt, None
+
+def character_rows(book_title, all_scenes, nums):
+    yield f"{book_title} | Characters", TITLE_STYLE
+    for idx, scene in enumerate(all_scenes, 1):
+        s_id = "ch" + nums[idx]
+        yield "Scene " + nums[idx] + ": " + scene.location, HEADING_STYLE
+        # role is validated as "Main" | "Secondary", so anything not in the table is Secondary.
+        main_ref = {"Main": s_id + "mc01"}
         for i, char in enumerate(scene.characters):
-            role_tag = "mc" if char.role == "Main" else "sc"
-            num = "01" if role_tag == "mc" else f"{i:02}"
-            doc3.add_paragraph(f"{char.name} ({s_id}{role_tag}{num}): {char.visual_description}")
-            
-        idx += 1
-        
-    def to_stream(d):
-        s = io.BytesIO(); d.save(s); s.seek(0); return s
+            ref = main_ref.get(char.role) or s_id + "sc" + nums[i]
+            yield char.name + " (" + ref + "): " + char.visual_description, None
+
+def generate_documents(book_title, all_scenes, low_memory=LOW_MEMORY):
+    max_chars = max((len(scene.characters) for scene in all_scenes), default=0)
+    nums = [f"{i:02}" for i in range(max(len(all_scenes), max_chars) + 1)]
+    write = stream_docx if low_memory else build_docx
     
-    return to_stream(doc1), to_stream(doc2), to_stream(doc3)
+    # The three documents are independent; lxml and zlib release the GIL, so the builders
+    # overlap on multi-core machines.
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(write, rows(book_title, all_scenes, nums)) for rows in (trigger_rows, skybox_rows, character_rows)]
+        return tuple(f.result() for f in futures)
 
 # --- 4. UI LOGIC ---
+# Each bar.progress call is a websocket message and a re-render, so updates are rate-limited.
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+def throttle_progress(report, interval=PROGRESS_INTERVAL_SECONDS, clock=time.monotonic):
+    """
+    Wraps report(done, total) so it runs at most once per interval, plus always on the last chapter.
+    """
+    last_update = clock()
+
+    def on_progress(done, total):
+        nonlocal last_update
+        now = clock()
+        # Completions arrive out of order, so the final one is recognized by count, not index.
+        if done == total or now - last_update >= interval:
+            last_update = now
+            report(done, total)
+    return on_progress
+
 st.title("OutPaged Scene Generator (OpenAI Edition)")
 
 # Secrets Logic
@@ -84,12 +247,22 @@ with st.sidebar:
         api_key = secret_key
     else:
         api_key = st.text_input("OpenAI API Key", type="password")
+    max_concurrency = st.slider("Parallel chapters", 1, 16, analyzer.MAX_CONCURRENCY,
+                                help="Lower this if your OpenAI tier hits rate limits.")
+    batch_size = st.slider("Chapters per request", 1, 12, analyzer.BATCH_MAX_CHUNKS,
+                           help="Several chapters share one prompt and round trip. 1 = one request per chapter.")
+    rpm = st.number_input("Requests / minute", 1, 30000, analyzer.DEFAULT_REQUESTS_PER_MINUTE)
+    tpm = st.number_input("Tokens / minute", 1000, 150000000, analyzer.DEFAULT_TOKENS_PER_MINUTE, step=1000)
+    low_memory = st.checkbox("Low-memory DOCX export", value=LOW_MEMORY,
+                             help="Streams the .docx files without building them in memory. Uses basic styles.")
 
 # File Upload
 uploaded_file = st.file_uploader("Upload EPUB", type=["epub"])
 
 if uploaded_file:
-    title, chapters = parse_epub(uploaded_file)
+    # getvalue() copies the upload each call; read it once and hand the same bytes to the parser.
+    raw = uploaded_file.getvalue()
+    title, chapters = parse_epub(raw)
     st.info(f"Book: {title} | Chapters: {len(chapters)}")
     
     if st.button("Generate Scenes"):
@@ -97,27 +270,35 @@ if uploaded_file:
             st.error("Missing API Key.")
             st.stop()
             
-        all_scenes = []
         bar = st.progress(0)
+        on_progress = throttle_progress(
+            lambda done, total: bar.progress(done / total, text=f"{done}/{total} chapters analyzed")
+        )
         
-        for i, chapter in enumerate(chapters):
-            bar.progress((i+1)/len(chapters))
-            
-            # CALL ANALYZER
-            scenes, error = analyzer.analyze_chapter_content(api_key, chapter, title)
-            
-            if error:
-                st.error(f"Chapter {i+1} Failed: {error}")
-            else:
-                all_scenes.extend(scenes)
+        # CALL ANALYZER (chapters, or batches of chapters, run concurrently)
+        if batch_size > 1:
+            all_scenes, errors = asyncio.run(analyzer.analyze_chapters_in_batches(
+                api_key, chapters, title, batch_size, max_concurrency, on_progress=on_progress,
+                requests_per_minute=rpm, tokens_per_minute=tpm
+            ))
+        else:
+            all_scenes, errors = asyncio.run(analyzer.analyze_chapters_concurrently(
+                api_key, chapters, title, max_concurrency, on_progress=on_progress,
+                requests_per_minute=rpm, tokens_per_minute=tpm
+            ))
+        
+        # A failed chapter only costs its own scenes; the rest of the book is still exported.
+        for i, error in errors:
+            st.warning(f"Chapter {i+1} Failed: {error}")
                 
         if not all_scenes:
             st.error("No scenes were generated. Check for errors above.")
         else:
             st.success(f"Success! {len(all_scenes)} scenes found.")
-            d1, d2, d3 = generate_documents(title, all_scenes)
+            d1, d2, d3 = generate_documents(title, all_scenes, low_memory)
             
-            c1, c2, c3 = st.columns(3)
+            c1, c2, c3, c4 = st.columns(4)
             c1.download_button("Triggers", d1, "Triggers.docx")
             c2.download_button("Skybox", d2, "Skybox.docx")
             c3.download_button("Characters", d3, "Characters.docx")
+            c4.download_button("Scene Pack", models.dump_scene_pack(all_scenes), "Scenes.json", mime="application/json")
@@ -0,0 +1,139 @@
+import os
+import sys
+from typing import List, Literal, Union
+import msgspec
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, field_validator
+from pydantic.json_schema import SkipJsonSchema
+
+# --- CONFIGURATION ---
+# Interned: every Skybox that isn't given its own negative prompt shares this one object.
+SKYBOX_NEGATIVE_PROMPT = sys.intern(
+    "people, person, faces, crowds, animals, text, letters, signage, "
+    "watermark, logo, UI, placeable props, furniture, vehicles, "
+    "modern objects, anachronistic items, blurry"
+)
+
+# --- HELPERS ---
+def unique_by_trigger(scenes: list) -> list:
+    """
+    Drops scenes whose trigger_sentence was already used, keeping the first.
+    Works on the pydantic models and the msgspec structs alike.
+    """
+    seen = set()
+    unique = []
+    for scene in scenes:
+        if scene.trigger_sentence not in seen:
+            seen.add(scene.trigger_sentence)
+            unique.append(scene)
+    return unique
+
+# --- DATA MODELS ---
+# Scenes are only built from already-validated data (see to_scene) and never mutated afterwards.
+MODEL_CONFIG = ConfigDict(frozen=True, extra="ignore", str_strip_whitespace=False)
+
+class Character(BaseModel):
+    model_config = MODEL_CONFIG
+
+    name: str = Field(..., description="Name of the character")
+    role: Literal["Main", "Secondary"] = Field(..., description="Role: 'Main' or 'Secondary'")
+    visual_description: str = Field(..., description="Visual description only. Full-body character cutout, no text cues.")
+
+class Skybox(BaseModel):
+    model_config = MODEL_CONFIG
+
+    visual_prompt: str = Field(..., description="Environment description. POV: ground view, center eye level.")
+    environment_type: Literal["Indoors", "Outdoors"] = Field(..., description="'Indoors' or 'Outdoors'")
+    # Filled in locally; left out of the schema sent to the model.
+    negative_prompt: SkipJsonSchema[str] = Field(default=SKYBOX_NEGATIVE_PROMPT)
+
+class Scene(BaseModel):
+    model_config = MODEL_CONFIG
+
+    location: str
+    chapter_beat: str
+    trigger_sentence: str = Field(..., description="Verbatim sentence from text.")
+    characters: List[Character]
+    skybox_environment: Skybox
+
+class ChapterOutput(BaseModel):
+    model_config = MODEL_CONFIG
+
+    scenes: List[Scene]
+
+    # Two scenes can't share a trigger sentence; drop the repeat rather than re-prompting.
+    _unique_triggers = field_validator("scenes")(unique_by_trigger)
+
+class ChunkResult(BaseModel):
+    model_config = MODEL_CONFIG
+
+    chapter_id: str
+    scenes: List[Scene]
+
+    _unique_triggers = field_validator("scenes")(unique_by_trigger)
+
+class BatchOutput(BaseModel):
+    model_config = MODEL_CONFIG
+
+    chunks: List[ChunkResult]
+
+# --- DECODE MODELS ---
+# msgspec mirrors of the models above: responses are parsed + validated by these in one C call,
+# then turned into the pydantic models without a second validation pass. Keep the fields in sync.
+# Frozen like the models; gc=False because decoded trees (strings and lists of structs) can't
+# form reference cycles, so the collector never needs to track or scan them.
+class CharacterStruct(msgspec.Struct, frozen=True, gc=False):
+    name: str
+    role: Literal["Main", "Secondary"]
+    visual_description: str
+
+class SkyboxStruct(msgspec.Struct, frozen=True, gc=False):
+    visual_prompt: str
+    environment_type: Literal["Indoors", "Outdoors"]
+    negative_prompt: str = SKYBOX_NEGATIVE_PROMPT
+
+class SceneStruct(msgspec.Struct, frozen=True, gc=False):
+    location: str
+    chapter_beat: str
+    trigger_sentence: str
+    characters: List[CharacterStruct]
+    skybox_environment: SkyboxStruct
+
+class ChapterOutputStruct(msgspec.Struct, frozen=True, gc=False):
+    scenes: List[SceneStruct]
+
+class ChunkResultStruct(msgspec.Struct, frozen=True, gc=False):
+    chapter_id: str
+    scenes: List[SceneStruct]
+
+class BatchOutputStruct(msgspec.Struct, frozen=True, gc=False):
+    chunks: List[ChunkResultStruct]
+
+CHAPTER_DECODER = msgspec.json.Decoder(ChapterOutputStruct)
+BATCH_DECODER = msgspec.json.Decoder(BatchOutputStruct)
+
+# --- CONVERSION ---
+def to_scene(s: SceneStruct) -> Scene:
+    # Already validated by msgspec, so build the pydantic models without re-running validation.
+    return Scene.model_construct(
+        location=s.location,
+        chapter_beat=s.chapter_beat,
+        trigger_sentence=s.trigger_sentence,
+        characters=[Character.model_construct(**msgspec.structs.asdict(c)) for c in s.characters],
+        skybox_environment=Skybox.model_construct(**msgspec.structs.asdict(s.skybox_environment)),
+    )
+
+def parse_scenes(raw_json: Union[str, bytes]) -> List[Scene]:
+    # The root must match ChapterOutput, i.e. the list is wrapped in a "scenes" key.
+    structured_data = CHAPTER_DECODER.decode(raw_json)
+    return [to_scene(s) for s in unique_by_trigger(structured_data.scenes)]
+
+# --- SERIALIZATION ---
+# pydantic-core serializes straight to JSON bytes, with no intermediate dicts or stdlib json.
+_SCENE_LIST = TypeAdapter(List[Scene])
+
+def dump_scene_pack(scenes: List[Scene]) -> bytes:
+    return _SCENE_LIST.dump_json(scenes, indent=2)
+
+def write_scene_pack(scenes: List[Scene], path: Union[str, os.PathLike]) -> None:
+    with open(path, "wb") as f:
+        f.write(dump_scene_pack(scenes))
@@ -0,0 +1,90 @@
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import diskcache
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analyzer  # noqa: E402
+
+
+# --- OFFLINE STAND-INS ---
+class ByteEncoding:
+    """
+    Replaces tiktoken, whose BPE files are downloaded on first use: one token per UTF-8 byte.
+    """
+    def encode_ordinary(self, text):
+        return list(text.encode())
+
+    def decode(self, tokens):
+        return bytes(tokens).decode(errors="ignore")
+
+
+@pytest.fixture(autouse=True)
+def offline_analyzer(monkeypatch, tmp_path):
+    monkeypatch.setattr(analyzer, "_get_encoding", lambda: ByteEncoding())
+    analyzer._prompt_tokens.cache_clear()
+    cache = diskcache.Cache(str(tmp_path / "llm_cache"))
+    monkeypatch.setattr(analyzer, "CACHE", cache)
+    analyzer.MODEL_STATS.clear()
+    yield
+    cache.close()
+    analyzer._prompt_tokens.cache_clear()
+
+
+# --- FAKE OPENAI ---
+def scene(trigger, characters=()):
+    return {
+        "location": "Hall",
+        "chapter_beat": "beat",
+        "trigger_sentence": trigger,
+        "characters": list(characters),
+        "skybox_environment": {"visual_prompt": "stone hall", "environment_type": "Indoors"},
+    }
+
+
+def chapter_json(*triggers):
+    return json.dumps({"scenes": [scene(t) for t in triggers]})
+
+
+def batch_json(scenes_by_id):
+    return json.dumps({"chunks": [
+        {"chapter_id": chapter_id, "scenes": [scene(t) for t in triggers]}
+        for chapter_id, triggers in scenes_by_id.items()
+    ]})
+
+
+def chunk_ids(request):
+    """
+    Chapter ids packed into a batched request, in order; empty for a single-chapter request.
+    """
+    user_content = request["messages"][1]["content"]
+    return [line[len("===CHUNK id="):-len("===")] for line in user_content.splitlines() if line.startswith("===CHUNK id=")]
+
+
+def _response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeAsyncClient:
+    """
+    AsyncOpenAI double, usable as `async with` like the real client.
+    handler(request) returns the response text or raises; every request's keyword arguments are recorded in .requests.
+    """
+    def __init__(self, handler):
+        self.requests = []
+        self._handler = handler
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.requests.append(kwargs)
+        return _response(self._handler(kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
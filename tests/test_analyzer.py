@@ -0,0 +1,239 @@
+import asyncio
+
+import pytest
+import tenacity
+from openai import RateLimitError
+
+import analyzer
+from conftest import FakeAsyncClient, batch_json, chapter_json, chunk_ids
+
+
+def is_batch(request):
+    return request["response_format"] is analyzer.BATCH_RESPONSE_FORMAT
+
+
+def rate_limit_error(code=None):
+    # Skips the constructor, which wants a real HTTP response.
+    error = RateLimitError.__new__(RateLimitError, "429")
+    error.code = code
+    return error
+
+
+# --- RATE LIMITING ---
+def test_rate_limiter_clamps_requests_larger_than_the_bucket():
+    async def run():
+        limiter = analyzer.RateLimiter(requests_per_minute=60, tokens_per_minute=100)
+        await asyncio.wait_for(limiter.acquire(10_000), timeout=1)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("code, attempts", [(None, 3), ("insufficient_quota", 1)])
+def test_create_completion_retries_rate_limits_through_the_limiter(monkeypatch, code, attempts):
+    monkeypatch.setattr(analyzer._create_completion_async.retry, "wait", tenacity.wait_none())
+    acquired = []
+
+    class Limiter:
+        async def acquire(self, n_tokens):
+            acquired.append(n_tokens)
+
+    def handler(request):
+        if len(client.requests) < 3:
+            raise rate_limit_error(code)
+        return chapter_json("a")
+
+    client = FakeAsyncClient(handler)
+
+    async def run():
+        return await analyzer._create_completion_async(client, Limiter(), 7, model="m")
+
+    if code is None:
+        assert asyncio.run(run()).choices[0].message.content == chapter_json("a")
+    else:
+        with pytest.raises(RateLimitError):
+            asyncio.run(run())
+    assert len(client.requests) == attempts
+    assert acquired == [7] * attempts
+
+
+def test_new_async_client_leaves_retries_to_tenacity():
+    assert analyzer._new_async_client("key").max_retries == 0
+
+
+# --- PREPROCESSING ---
+def test_clean_chunk_strips_noise_and_collapses_whitespace():
+    raw = "\ufeff  It was[cite_start] a  dark\tnight.[cite: 5]\u200b \n \n\n  Then   dawn.  \nEnd.  "
+    assert analyzer._clean_chunk(raw) == "It was a dark night.\n\nThen dawn. \nEnd."
+
+
+# --- BATCHING ---
+def test_truncate_chunk_trims_to_the_token_budget():
+    prompt = "p" * 10
+    budget = analyzer.MAX_CONTEXT_TOKENS - analyzer.RESPONSE_RESERVE_TOKENS - analyzer.REQUEST_OVERHEAD_TOKENS - 10
+    assert analyzer._truncate_chunk("short text", prompt) == ("short text", 10)
+
+    text, n_tokens = analyzer._truncate_chunk("x" * (budget + 50), prompt)
+    assert text == "x" * budget and n_tokens == budget
+
+    # A longer system prompt leaves less room for the chunk.
+    text, n_tokens = analyzer._truncate_chunk("x" * (budget + 50), prompt * 2)
+    assert n_tokens == budget - 10
+
+
+def test_pack_chunks_respects_token_and_count_limits():
+    chunks = [(str(i), "x" * 40, 40) for i in range(5)]
+    packed = list(analyzer._pack_chunks(chunks, max_tokens=100, max_chunks=3))
+    assert [[chapter_id for chapter_id, _, _ in batch] for batch, _ in packed] == [["0", "1"], ["2", "3"], ["4"]]
+    assert [n_tokens for _, n_tokens in packed] == [80, 80, 40]
+
+    packed = list(analyzer._pack_chunks(chunks, max_tokens=1000, max_chunks=2))
+    assert [len(batch) for batch, _ in packed] == [2, 2, 1]
+
+
+def test_pack_chunks_sends_oversized_chunk_alone():
+    chunks = [("a", "x" * 10, 10), ("b", "x" * 500, 500), ("c", "x" * 10, 10)]
+    packed = list(analyzer._pack_chunks(chunks, max_tokens=100, max_chunks=6))
+    assert [[chapter_id for chapter_id, _, _ in batch] for batch, _ in packed] == [["a"], ["b"], ["c"]]
+
+
+def test_collect_keeps_input_order_and_reports_errors():
+    first, second, third = (analyzer.parse_scenes(chapter_json(t)) for t in "abc")
+    scenes, errors = analyzer._collect([(first, None), ([], "boom"), (second + third, None)])
+    assert [s.trigger_sentence for s in scenes] == ["a", "b", "c"]
+    assert errors == [(1, "boom")]
+
+
+# --- BATCHED ANALYSIS ---
+def test_analyze_batch_escalates_only_missing_and_thin_chunks():
+    def handler(request):
+        if request["model"] == analyzer.MODELS[0]:
+            return batch_json({"a": ["a1", "a2"], "b": ["b1"]})
+        return batch_json({"b": ["b1", "b2"], "c": ["c1", "c2"]})
+
+    client = FakeAsyncClient(handler)
+    results = {}
+    batch = [("a", "text a", 6), ("b", "text b", 6), ("c", "text c", 6)]
+    asyncio.run(analyzer._analyze_batch_async(client, None, batch, 18, "batch prompt", "chapter prompt", results))
+
+    assert [chunk_ids(r) for r in client.requests] == [["a", "b", "c"], ["b", "c"]]
+    assert {chapter_id: [s.trigger_sentence for s in scenes] for chapter_id, scenes in results.items()} == {
+        "a": ["a1", "a2"], "b": ["b1", "b2"], "c": ["c1", "c2"],
+    }
+
+
+def test_analyze_chapters_in_batches_keeps_partial_batch_and_resends_the_rest(monkeypatch):
+    def handler(request):
+        if not is_batch(request):
+            return chapter_json("single1", "single2")
+        if request["model"] == analyzer.MODELS[0]:
+            return batch_json({"0": ["a1", "a2"]})
+        raise RuntimeError("batch failed")
+
+    client = FakeAsyncClient(handler)
+    monkeypatch.setattr(analyzer, "_new_async_client", lambda api_key: client)
+    scenes, errors = asyncio.run(analyzer.analyze_chapters_in_batches("key", ["text a", "text b"], "Book"))
+
+    assert errors == []
+    assert [s.trigger_sentence for s in scenes] == ["a1", "a2", "single1", "single2"]
+    assert sum(not is_batch(r) for r in client.requests) == 1
+
+
+def test_analyze_chapters_in_batches_reports_chapters_that_still_fail(monkeypatch):
+    def handler(request):
+        raise RuntimeError("down")
+
+    monkeypatch.setattr(analyzer, "_new_async_client", lambda api_key: FakeAsyncClient(handler))
+    scenes, errors = asyncio.run(analyzer.analyze_chapters_in_batches("key", ["text a", "text b"], "Book"))
+    assert scenes == []
+    assert errors == [(0, "down"), (1, "down")]
+
+
+def test_analyze_chapters_in_batches_paces_resends_and_skips_cached(monkeypatch):
+    acquired = []
+
+    async def acquire(self, n_tokens):
+        acquired.append(n_tokens)
+
+    monkeypatch.setattr(analyzer.RateLimiter, "acquire", acquire)
+
+    def handler(request):
+        if not is_batch(request):
+            return chapter_json("s1", "s2")
+        ids = chunk_ids(request)
+        if "1" in ids:
+            raise RuntimeError("batch failed")
+        return batch_json({chapter_id: [f"{chapter_id}-1", f"{chapter_id}-2"] for chapter_id in ids})
+
+    client = FakeAsyncClient(handler)
+    monkeypatch.setattr(analyzer, "_new_async_client", lambda api_key: client)
+    chunks = ["text 0", "text 1", "text 2", "text 3"]
+    progress = []
+
+    scenes, errors = asyncio.run(analyzer.analyze_chapters_in_batches(
+        "key", chunks, "Book", batch_size=2, on_progress=lambda done, total: progress.append((done, total))
+    ))
+    assert errors == []
+    # Chapter 1 broke its batch; chapter 0 is re-sent with it, one request each, and order is kept.
+    assert [s.trigger_sentence for s in scenes] == ["s1", "s2", "s1", "s2", "2-1", "2-2", "3-1", "3-2"]
+    assert len(acquired) == len(client.requests) == 4
+    assert progress[-1] == (4, 4)
+
+    acquired.clear()
+    client.requests.clear()
+    scenes, errors = asyncio.run(analyzer.analyze_chapters_in_batches("key", chunks, "Book", batch_size=2))
+    assert len(scenes) == 8 and errors == []
+    assert acquired == [] and client.requests == []
+
+
+@pytest.mark.parametrize("thin_first", [True, False])
+def test_analyze_chapter_content_escalates_thin_results(monkeypatch, thin_first):
+    def handler(request):
+        if request["model"] == analyzer.MODELS[0] and thin_first:
+            return chapter_json("only")
+        return chapter_json("x", "y", "x")
+
+    client = FakeAsyncClient(handler)
+    monkeypatch.setattr(analyzer, "_new_async_client", lambda api_key: client)
+    scenes, error = analyzer.analyze_chapter_content("key", "some chapter text", "Book")
+
+    assert error is None
+    assert [s.trigger_sentence for s in scenes] == ["x", "y"]
+    assert [r["model"] for r in client.requests] == (analyzer.MODELS if thin_first else analyzer.MODELS[:1])
+
+
+def test_analyze_chapter_content_keeps_best_result_and_never_caches_empty(monkeypatch):
+    answers = {analyzer.MODELS[0]: chapter_json("only"), analyzer.MODELS[-1]: chapter_json()}
+    client = FakeAsyncClient(lambda request: answers[request["model"]])
+    monkeypatch.setattr(analyzer, "_new_async_client", lambda api_key: client)
+
+    scenes, error = analyzer.analyze_chapter_content("key", "thin chapter", "Book")
+    assert error is None
+    assert [s.trigger_sentence for s in scenes] == ["only"]
+
+    # The thin answer was cached: a second run sends nothing.
+    client.requests.clear()
+    scenes, _ = analyzer.analyze_chapter_content("key", "thin chapter", "Book")
+    assert [s.trigger_sentence for s in scenes] == ["only"] and client.requests == []
+
+    answers[analyzer.MODELS[0]] = chapter_json()
+    scenes, error = analyzer.analyze_chapter_content("key", "empty chapter", "Book")
+    assert scenes == [] and error == "Only 0 scenes found"
+    client.requests.clear()
+    analyzer.analyze_chapter_content("key", "empty chapter", "Book")
+    assert len(client.requests) == len(analyzer.MODELS)
+
+
+def test_analyze_batch_keeps_best_thin_result_and_never_caches_empty():
+    def handler(request):
+        if request["model"] == analyzer.MODELS[0]:
+            return batch_json({"a": ["a1"], "b": []})
+        return batch_json({"a": [], "b": []})
+
+    client = FakeAsyncClient(handler)
+    results = {}
+    batch = [("a", "text a", 6), ("b", "text b", 6)]
+    asyncio.run(analyzer._analyze_batch_async(client, None, batch, 12, "batch prompt", "chapter prompt", results))
+
+    assert {chapter_id: [s.trigger_sentence for s in scenes] for chapter_id, scenes in results.items()} == {"a": ["a1"], "b": []}
+    assert analyzer._check_cache("chapter prompt", "text a")[0] is not None
+    assert analyzer._check_cache("chapter prompt", "text b")[0] is None
@@ -0,0 +1,111 @@
+import io
+import json
+
+from docx import Document
+
+import app
+import models
+from conftest import scene
+
+
+def read_back(stream):
+    doc = Document(io.BytesIO(stream.getvalue()))
+    assert doc.element.body[-1].tag.endswith("}sectPr")
+    return [(p.style.name, p.text) for p in doc.paragraphs]
+
+
+def test_build_and_stream_docx_produce_the_same_documents():
+    cast = [
+        {"name": "Ann", "role": "Main", "visual_description": "red coat"},
+        {"name": "Bo", "role": "Secondary", "visual_description": "grey <hat> & cane"},
+    ]
+    scenes = models.parse_scenes(json.dumps({"scenes": [scene("a", cast), scene("b")]}))
+
+    built = app.generate_documents("Book", scenes, low_memory=False)
+    streamed = app.generate_documents("Book", scenes, low_memory=True)
+
+    for built_doc, streamed_doc in zip(built, streamed):
+        assert read_back(built_doc) == read_back(streamed_doc)
+
+    triggers, skybox, characters = (read_back(d) for d in streamed)
+    assert triggers[:4] == [
+        ("Title", "Book | Triggers"),
+        ("Heading 2", "Scene 01: Hall"),
+        ("Normal", "Trigger: a"),
+        ("Normal", "Page: N/A"),
+    ]
+    assert ("Normal", "File: ch02bg01") in skybox
+    assert ("Normal", "Negative: " + models.SKYBOX_NEGATIVE_PROMPT) in skybox
+    assert characters[2:4] == [
+        ("Normal", "Ann (ch01mc01): red coat"),
+        ("Normal", "Bo (ch01sc01): grey <hat> & cane"),
+    ]
+
+
+def test_both_writers_drop_characters_xml_cannot_hold():
+    rows = [("Title\x0b", app.TITLE_STYLE), ("tab\tand\x00nul\x1f", None)]
+    built, streamed = app.build_docx(rows), app.stream_docx(rows)
+    assert read_back(built) == read_back(streamed) == [("Title", "Title"), ("Normal", "tab\tandnul")]
+
+
+def write_book(path, *chapters, spine=None):
+    from ebooklib import epub
+
+    book = epub.EpubBook()
+    book.set_identifier("id")
+    book.set_title("Test Book")
+    for chapter in (*chapters, epub.EpubNcx(), epub.EpubNav()):
+        book.add_item(chapter)
+    book.spine = list(spine or chapters)
+    epub.write_epub(str(path), book)
+    return path.read_bytes()
+
+
+def test_parse_epub_skips_chrome_and_short_documents(tmp_path):
+    from ebooklib import epub
+
+    chapter = epub.EpubHtml(title="One", file_name="one.xhtml")
+    chapter.content = "<html><body><nav>Contents</nav><script>x = 1</script>" + "<p>It was a dark night.</p>" * 40 + "</body></html>"
+    stub = epub.EpubHtml(title="Two", file_name="two.xhtml")
+    stub.content = "<html><body><p>Short.</p></body></html>"
+
+    title, chapters = app.parse_epub(write_book(tmp_path / "book.epub", chapter, stub))
+    assert title == "Test Book"
+    assert len(chapters) == 1
+    assert chapters[0].splitlines()[:2] == ["It was a dark night.", "It was a dark night."]
+    assert "Contents" not in chapters[0] and "x = 1" not in chapters[0]
+
+
+def test_parse_epub_keeps_short_chapters_with_little_markup(tmp_path):
+    from ebooklib import epub
+
+    chapter = epub.EpubHtml(title="One", file_name="one.xhtml")
+    # Just over MIN_CHAPTER_CHARS of text in a document under 800 bytes.
+    chapter.content = "<html><body><p>" + "a" * 510 + "</p></body></html>"
+
+    _, chapters = app.parse_epub(write_book(tmp_path / "book.epub", chapter))
+    assert chapters == ["a" * 510]
+
+
+def test_parse_epub_follows_spine_order(tmp_path):
+    from ebooklib import epub
+
+    first = epub.EpubHtml(title="One", file_name="one.xhtml")
+    first.content = "<html><body>" + "<p>First chapter.</p>" * 40 + "</body></html>"
+    second = epub.EpubHtml(title="Two", file_name="two.xhtml")
+    second.content = "<html><body>" + "<p>Second chapter.</p>" * 40 + "</body></html>"
+
+    # Manifest order is second, first; the spine says first, second.
+    _, chapters = app.parse_epub(write_book(tmp_path / "book.epub", second, first, spine=[first, second]))
+    assert [c.splitlines()[0] for c in chapters] == ["First chapter.", "Second chapter."]
+
+
+def test_throttle_progress_limits_updates_but_always_reports_the_last():
+    now = [0.0]
+    reported = []
+    on_progress = app.throttle_progress(lambda done, total: reported.append(done), interval=0.5, clock=lambda: now[0])
+
+    for done, at in [(1, 0.1), (2, 0.6), (3, 0.7), (4, 0.8), (5, 0.9)]:
+        now[0] = at
+        on_progress(done, 5)
+    assert reported == [2, 5]
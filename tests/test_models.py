@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from pydantic import ValidationError
+
+import models
+from conftest import chapter_json, scene
+
+
+def test_unique_by_trigger_keeps_first_scene_per_trigger():
+    structs = models.CHAPTER_DECODER.decode(chapter_json("a", "b", "a", "c", "b")).scenes
+    unique = models.unique_by_trigger(structs)
+    assert [s.trigger_sentence for s in unique] == ["a", "b", "c"]
+    assert unique[0] is structs[0]
+
+
+def test_parse_scenes_dedupes_and_fills_negative_prompt():
+    scenes = models.parse_scenes(chapter_json("a", "a", "b"))
+    assert [s.trigger_sentence for s in scenes] == ["a", "b"]
+    assert all(s.skybox_environment.negative_prompt == models.SKYBOX_NEGATIVE_PROMPT for s in scenes)
+
+
+def test_parse_scenes_rejects_unknown_role():
+    bad = scene("a", characters=[{"name": "Ann", "role": "Villain", "visual_description": "tall"}])
+    with pytest.raises(Exception):
+        models.parse_scenes(json.dumps({"scenes": [bad]}))
+
+
+def test_chapter_output_dedupes_and_is_frozen():
+    output = models.ChapterOutput.model_validate_json(chapter_json("a", "a"))
+    assert len(output.scenes) == 1
+    with pytest.raises(ValidationError):
+        output.scenes[0].location = "Elsewhere"
+
+
+def test_dump_scene_pack_round_trips():
+    scenes = models.parse_scenes(chapter_json("a", "b"))
+    dumped = json.loads(models.dump_scene_pack(scenes))
+    assert [s["trigger_sentence"] for s in dumped] == ["a", "b"]
+    assert dumped[0]["skybox_environment"]["negative_prompt"] == models.SKYBOX_NEGATIVE_PROMPT